@@ -1,10 +1,16 @@
+import io
 import os
+import argparse
 import zipfile
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
+from typing import Dict, List, Tuple
 
 import cdsapi
+import numpy as np
 import xarray as xr
+from requests.adapters import HTTPAdapter
 
 # ================== НАСТРОЙКИ ==================
 OUTPUT_ROOT = r"D:\Xalim\wind_visual\ADS_GASES_test_2026_new"  # базовая папка
@@ -24,46 +30,80 @@ LEADTIME_HOUR = "0"
 START_DAY = date(2025, 12, 20)
 END_DAY   = date(2026, 1, 7)
 
+# сколько запросов одновременно держим в очереди CDS
+MAX_WORKERS = 5
 
-# 7 параметров
-# AERAI = AOD550 (это не UVAI 1:1, но ежедневный аэрозольный индикатор из CAMS)
-GASES = {
+
+# 5 рабочих параметров — качаются всегда
+GASES_ACTIVE = {
     "CO":    ("total_column_carbon_monoxide",        "tcco"),
     "NO2":   ("total_column_nitrogen_dioxide",       "tcno2"),
     "SO2":   ("total_column_sulphur_dioxide",        "tcso2"),
     "HCHO":  ("total_column_formaldehyde",           "tchcho"),
     "O3":    ("total_column_ozone",                  "gtco3"),
-    "CH4":   ("total_column_methane",                "tc_ch4"), #НЕ НУЖЕН
-    "AERAI": ("total_aerosol_optical_depth_550nm",   "aod550"), #НЕ НУЖЕН
+}
+
+# НЕ НУЖНЫ: каждый — лишний запрос в очередь CDS на каждый день,
+# поэтому качаются только с флагом --include-archived
+# AERAI = AOD550 (это не UVAI 1:1, но ежедневный аэрозольный индикатор из CAMS)
+GASES_ARCHIVED = {
+    "CH4":   ("total_column_methane",                "tc_ch4"),
+    "AERAI": ("total_aerosol_optical_depth_550nm",   "aod550"),
 }
 
 
 
-def extract_first_nc(zip_path: str, extract_dir: str) -> str:
+def read_all_nc(zip_path: str) -> List[bytes]:
     with zipfile.ZipFile(zip_path, "r") as z:
-        z.extractall(extract_dir)
-        nc_files = [
-            os.path.join(extract_dir, n)
+        nc_data = [
+            z.read(n)
             for n in z.namelist()
             if n.lower().endswith((".nc", ".nc4", ".cdf"))
         ]
-    if not nc_files:
+    if not nc_data:
         raise RuntimeError("В ZIP не найден NetCDF (.nc/.nc4/.cdf).")
-    return nc_files[0]
+    return nc_data
 
 
-def pick_dataarray(ds: xr.Dataset, ads_var: str, short_var: str) -> xr.DataArray:
+def pick_dataarray(ds: xr.Dataset, ads_var: str, short_var: str,
+                   allow_fallback: bool = True) -> xr.DataArray:
     if short_var in ds.data_vars:
         return ds[short_var]
     if ads_var in ds.data_vars:
         return ds[ads_var]
-    if len(ds.data_vars) == 1:
+    if allow_fallback and len(ds.data_vars) == 1:
         only = list(ds.data_vars.keys())[0]
         print(f"⚠ Не нашёл {short_var}/{ads_var}. Беру единственную переменную: {only}")
         return ds[only]
     raise RuntimeError(f"Не нашёл переменную. Есть: {list(ds.data_vars.keys())}")
 
 
+def pick_from_datasets(datasets: List[xr.Dataset], ads_var: str, short_var: str,
+                       allow_fallback: bool = True) -> xr.DataArray:
+    # в ZIP может быть один .nc со всеми переменными или по файлу на переменную.
+    # allow_fallback=False, если в запросе было несколько газов: иначе единственная
+    # переменная чужого газа молча легла бы в TIF этого газа.
+    for ds in datasets:
+        if short_var in ds.data_vars or ads_var in ds.data_vars:
+            return pick_dataarray(ds, ads_var=ads_var, short_var=short_var)
+    if len(datasets) == 1:
+        return pick_dataarray(datasets[0], ads_var=ads_var, short_var=short_var,
+                              allow_fallback=allow_fallback)
+    raise RuntimeError(f"Не нашёл {short_var}/{ads_var} ни в одном NetCDF из ZIP")
+
+
+def _mean_over(da: xr.DataArray, dim: str) -> xr.DataArray:
+    # одна редукция по ndarray вместо da.mean (без промежуточных копий xarray)
+    axis = da.get_axis_num(dim)
+    values = da.values.astype(np.float32, copy=False)
+    data = np.add.reduce(values, axis=axis) / np.float32(da.sizes[dim])
+    if np.isnan(data).any():
+        data = np.nanmean(values, axis=axis)  # как da.mean(skipna=True)
+
+    coords = {c: da.coords[c] for c in da.coords if dim not in da.coords[c].dims}
+    return xr.DataArray(data, dims=[d for d in da.dims if d != dim], coords=coords, attrs=da.attrs)
+
+
 def collapse_to_2d_latlon(da: xr.DataArray) -> xr.DataArray:
     if "longitude" in da.dims and "latitude" in da.dims:
         x_dim, y_dim = "longitude", "latitude"
@@ -77,7 +117,7 @@ def collapse_to_2d_latlon(da: xr.DataArray) -> xr.DataArray:
         if dim in (x_dim, y_dim):
             continue
         if da.sizes.get(dim, 1) > 1:
-            da = da.mean(dim)
+            da = _mean_over(da, dim)
         else:
             da = da.isel({dim: 0})
 
@@ -100,73 +140,109 @@ def safe_remove_file(path: str):
         print(f"⚠ Не смог удалить файл {path}: {e}")
 
 
-def safe_remove_dir(path: str):
-    try:
-        if os.path.isdir(path):
-            shutil.rmtree(path, ignore_errors=False)
-    except Exception as e:
-        print(f"⚠ Не смог удалить папку {path}: {e}")
-
-
-def download_one(day: date, label: str, ads_var: str, short_var: str, client: cdsapi.Client):
+def download_day_all_gases(day: date, gases: Dict[str, Tuple[str, str]], client: cdsapi.Client):
     day_str = day.strftime("%Y-%m-%d")
 
-    out_dir = os.path.join(OUTPUT_ROOT, label)
-    os.makedirs(out_dir, exist_ok=True)
+    todo = {}
+    for label, (ads_var, short_var) in gases.items():
+        out_dir = os.path.join(OUTPUT_ROOT, label)
+        os.makedirs(out_dir, exist_ok=True)
+
+        out_tif = os.path.join(out_dir, f"{label}_{day_str}_ADS.tif")
+        if os.path.exists(out_tif):
+            print(f"✔ [{label}] Уже есть: {out_tif}")
+            continue
+        todo[label] = (ads_var, short_var, out_tif)
 
-    out_tif = os.path.join(out_dir, f"{label}_{day_str}_ADS.tif")
-    if os.path.exists(out_tif):
-        print(f"✔ [{label}] Уже есть: {out_tif}")
+    if not todo:
         return
 
-    tmp_zip = os.path.join(out_dir, f"_tmp_{label}_{day_str}.zip")
-    tmp_dir = os.path.join(out_dir, f"_tmp_{label}_{day_str}")
+    tmp_zip = os.path.join(OUTPUT_ROOT, f"_tmp_{day_str}.zip")
 
-    area = [TOP_LAT, LEFT_LON, BOTTOM_LAT, RIGHT_LON]  
+    area = [TOP_LAT, LEFT_LON, BOTTOM_LAT, RIGHT_LON]
 
+    # один запрос на день со всеми недостающими газами, делим локально
     request = {
         "date": day_str,
         "type": REQUEST_TYPE,
-        "variable": ads_var,
+        "variable": [ads_var for ads_var, _, _ in todo.values()],
         "time": TIMES,
         "leadtime_hour": LEADTIME_HOUR,
         "format": FORMAT,
         "area": area,
     }
 
-    print(f"\n=== {label} | {day_str} ===")
+    print(f"\n=== {', '.join(todo)} | {day_str} ===")
     client.retrieve(DATASET_ID, request, tmp_zip)
 
-    os.makedirs(tmp_dir, exist_ok=True)
-
+    datasets = []
     try:
-        nc_path = extract_first_nc(tmp_zip, tmp_dir)
-
-        with xr.open_dataset(nc_path, engine="netcdf4") as ds:
-            da = pick_dataarray(ds, ads_var=ads_var, short_var=short_var).load()
+        # NetCDF читаем прямо из ZIP в память, без распаковки на диск
+        for nc_bytes in read_all_nc(tmp_zip):
+            datasets.append(xr.open_dataset(io.BytesIO(nc_bytes), engine="h5netcdf"))
 
-        da2d = collapse_to_2d_latlon(da)
-        da2d.rio.to_raster(out_tif)
-        print(f"✅ [{label}] Готово: {out_tif}")
+        single_gas = len(todo) == 1
+        for label, (ads_var, short_var, out_tif) in todo.items():
+            try:
+                da = pick_from_datasets(datasets, ads_var=ads_var, short_var=short_var,
+                                        allow_fallback=single_gas).load()
+                da2d = collapse_to_2d_latlon(da)
+                da2d.rio.to_raster(out_tif)
+                print(f"✅ [{label}] Готово: {out_tif}")
+            except Exception as e:
+                print(f"❌ Ошибка [{label}] {day}: {e}")
 
     finally:
+        for ds in datasets:
+            ds.close()
         safe_remove_file(tmp_zip)
-        safe_remove_dir(tmp_dir)
 
 
-def main():
+_tls = threading.local()
+
+
+def _thread_client() -> cdsapi.Client:
+    # cdsapi.Client хранит состояние запроса -> один клиент на поток
+    client = getattr(_tls, "client", None)
+    if client is None:
+        client = cdsapi.Client()
+        # держим TLS-соединения к CDS открытыми между опросами/скачиваниями
+        session = getattr(client, "session", None)
+        if session is not None:
+            session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=8))
+        _tls.client = client
+    return client
+
+
+def _download_task(day: date, gases: Dict[str, Tuple[str, str]]):
+    download_day_all_gases(day, gases, _thread_client())
+
+
+def main(include_archived: bool = False):
     os.makedirs(OUTPUT_ROOT, exist_ok=True)
-    client = cdsapi.Client()
 
+    gases = dict(GASES_ACTIVE)
+    if include_archived:
+        gases.update(GASES_ARCHIVED)
+
+    days = []
     day = START_DAY
     while day <= END_DAY:
-        for label, (ads_var, short_var) in GASES.items():
+        days.append(day)
+        day += timedelta(days=1)
+
+    # уже скачанные tif пропускаются внутри download_day_all_gases -> можно перезапускать
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futs = {ex.submit(_download_task, d, gases): d for d in days}
+        for fut in as_completed(futs):
             try:
-                download_one(day, label, ads_var, short_var, client)
+                fut.result()
             except Exception as e:
-                print(f"❌ Ошибка [{label}] {day}: {e}")
-        day += timedelta(days=1)
+                print(f"❌ Ошибка {futs[fut]}: {e}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--include-archived", action="store_true",
+                        help="качать также CH4 и AERAI")
+    main(include_archived=parser.parse_args().include_archived)
@@ -0,0 +1 @@
+# корень репо в sys.path: тесты импортируют модули напрямую (import graph)
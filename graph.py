@@ -1,17 +1,18 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import re
-import json
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import List, Tuple, Dict
 
 import numpy as np
-import rioxarray
-
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+import rasterio
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask, geometry_window
+from shapely import wkb as shapely_wkb
 
 from osgeo import ogr, osr
 
@@ -28,31 +29,51 @@ GAS_UNITS = {
     "AERAI": "",
 }
 
+CHART_DPI = 120
+
+# кэш блоков GDAL, без readdir на каждый open.
+# GDAL_NUM_THREADS не ставим: читаем и так пулом потоков в нескольких процессах,
+# а tiff маленькие однобандовые — лишние потоки распаковки только мешают.
+GDAL_READ_ENV = {
+    "GDAL_CACHEMAX": 512,
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+}
+READ_THREADS = 8
+
 
+_DATE_RE = re.compile(r"(\d{4}-\d{2}-\d{2}|\d{8}|\d{2}-\d{2}-\d{4})")
+
+
+@lru_cache(maxsize=4096)
 def _parse_date_from_filename(path: str) -> datetime:
     base = os.path.basename(path)
-    m = re.search(r"(\d{4}-\d{2}-\d{2}|\d{8}|\d{2}-\d{2}-\d{4})", base)
+    m = _DATE_RE.search(base)
     if not m:
         raise ValueError(f"Can't parse date from filename: {path}")
 
     d = m.group(1)
-    for fmt in ("%Y-%m-%d", "%Y%m%d", "%d-%m-%Y"):
-        try:
-            return datetime.strptime(d, fmt).replace(hour=0, minute=0, second=0, microsecond=0)
-        except ValueError:
-            pass
-    raise ValueError(f"Can't parse date from filename: {path}")
+    if len(d) == 8:
+        fmt = "%Y%m%d"
+    elif d[4] == "-":
+        fmt = "%Y-%m-%d"
+    else:
+        fmt = "%d-%m-%Y"
+    try:
+        return datetime.strptime(d, fmt)
+    except ValueError:
+        raise ValueError(f"Can't parse date from filename: {path}") from None
 
 
 def _list_tiffs(rasters_root: str, gas: str) -> List[str]:
     folder = os.path.join(rasters_root, gas.upper())
     if not os.path.isdir(folder):
         return []
-    return sorted(
-        os.path.join(folder, f)
-        for f in os.listdir(folder)
-        if f.lower().endswith(".tif")
-    )
+    with os.scandir(folder) as it:
+        return sorted(
+            e.path
+            for e in it
+            if e.name.lower().endswith(".tif") and e.is_file()
+        )
 
 
 def _open_layer(shp_path: str):
@@ -65,11 +86,36 @@ def _open_layer(shp_path: str):
     return ds, lyr
 
 
-def _get_feature_and_name(lyr, parent_cod: int):
-    lyr.SetAttributeFilter(f"parent_cod = {int(parent_cod)}")
-    feat = lyr.GetNextFeature()
-    lyr.SetAttributeFilter(None)
-    lyr.ResetReading()
+def _index_parent_cod(lyr) -> Dict[int, int]:
+    # один проход по слою, читаем только parent_cod (без геометрии и прочих полей)
+    defn = lyr.GetLayerDefn()
+    ignored = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    ignored = [n for n in ignored if n.lower() != "parent_cod"] + ["OGR_GEOMETRY"]
+
+    fid_by_cod: Dict[int, int] = {}
+    lyr.SetIgnoredFields(ignored)
+    try:
+        lyr.ResetReading()
+        for feat in lyr:
+            cod = feat.GetField("parent_cod")
+            if cod is not None:
+                fid_by_cod.setdefault(int(cod), feat.GetFID())
+    finally:
+        lyr.SetIgnoredFields([])
+        lyr.ResetReading()
+    return fid_by_cod
+
+
+# shp держим открытым между вызовами make_grafik; ds в кортеже, чтобы OGR его не закрыл
+@lru_cache(maxsize=4)
+def _cached_layer(shp_path: str):
+    ds, lyr = _open_layer(shp_path)
+    return ds, lyr, lyr.GetSpatialRef(), _index_parent_cod(lyr)
+
+
+def _get_feature_and_name(lyr, fid_by_cod: Dict[int, int], parent_cod: int):
+    fid = fid_by_cod.get(int(parent_cod))
+    feat = lyr.GetFeature(fid) if fid is not None else None
     if not feat:
         raise RuntimeError(f"parent_cod={parent_cod} не найден в shp")
     name = feat.GetField("region_nam") or feat.GetField("region_name") or str(parent_cod)
@@ -81,7 +127,7 @@ def _srs_axis(srs: osr.SpatialReference) -> osr.SpatialReference:
     return srs
 
 
-def _geom_to_raster_geojson(geom: ogr.Geometry, vec_srs: osr.SpatialReference, ras_crs) -> dict:
+def _geom_to_raster_shape(geom: ogr.Geometry, vec_srs: osr.SpatialReference, ras_crs):
     ras_srs = osr.SpatialReference()
     if ras_crs is None:
         ras_srs.ImportFromEPSG(4326)
@@ -103,15 +149,45 @@ def _geom_to_raster_geojson(geom: ogr.Geometry, vec_srs: osr.SpatialReference, r
         ct = osr.CoordinateTransformation(vec_srs, ras_srs)
         g2.Transform(ct)
 
-    return json.loads(g2.ExportToJson())
+    # WKB -> shapely напрямую, без сериализации в JSON и обратно
+    return shapely_wkb.loads(bytes(g2.ExportToWkb()))
+
+
+def _region_window(geom: ogr.Geometry, vec_srs: osr.SpatialReference, src):
+    # читаем только окно вокруг полигона; маска — в координатах этого окна
+    poly_geo = _geom_to_raster_shape(geom, vec_srs, src.crs)
+    try:
+        win = geometry_window(src, [poly_geo])
+    except WindowError:
+        return None, np.empty(0, dtype=np.intp)
+    inside = geometry_mask([poly_geo], out_shape=(int(win.height), int(win.width)),
+                           transform=src.window_transform(win), invert=True)
+    return win, np.flatnonzero(inside.ravel())
+
+
+def _read_and_reduce(tif_path: str, gas: str, region_idx) -> float:
+    # вызывается внутри rasterio.Env потока (см. _read_batch)
+    with rasterio.open(tif_path) as src:
+        win, flat_idx = region_idx(src)
+        if win is None:
+            return 0.0
+        arr = src.read(1, window=win)
+    return _compute_mean(gas, arr.take(flat_idx))
+
+
+def _read_batch(tif_paths: List[str], gas: str, region_idx) -> List[float]:
+    # Env в rasterio живёт в потоке -> один Env на поток и пачку файлов, а не на каждый файл
+    with rasterio.Env(**GDAL_READ_ENV):
+        return [_read_and_reduce(p, gas, region_idx) for p in tif_paths]
 
 
 def _compute_mean(gas: str, values: np.ndarray) -> float:
-    v = values[np.isfinite(values)]
-    v = v[(v < 1e20)]
-    if v.size == 0:
+    m = np.isfinite(values) & (values < 1e20)
+    n = int(np.count_nonzero(m))
+    if n == 0:
         return 0.0
-    raw = float(np.nanmean(v))
+    # axis=None: сумма по всем осям, окно может прийти и 2-D
+    raw = float(np.add.reduce(values, axis=None, where=m, dtype=np.float64)) / n
 
     if gas == "CH4":
         return round(raw / 1000.0, 3)
@@ -129,98 +205,102 @@ def _dedupe_by_date(selected: List[Tuple[datetime, str]]) -> List[Tuple[datetime
     return sorted(by_day.items(), key=lambda x: x[0])
 
 
-def _smooth_curve(dts: List[datetime], ys: np.ndarray, n_points: int = 400):
-    x = mdates.date2num(dts).astype(float)
-    y = ys.astype(float)
+# matplotlib грузим только когда реально строим график
+_MPL = None
 
-    order = np.argsort(x)
-    x = x[order]
-    y = y[order]
 
-    uniq_x, uniq_y = [], []
-    last = None
-    acc = []
-    for xi, yi in zip(x, y):
-        if last is None or xi == last:
-            acc.append(yi)
-            last = xi
-        else:
-            uniq_x.append(last)
-            uniq_y.append(float(np.mean(acc)))
-            acc = [yi]
-            last = xi
-    if last is not None:
-        uniq_x.append(last)
-        uniq_y.append(float(np.mean(acc)))
+def _mpl():
+    global _MPL
+    if _MPL is None:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import matplotlib.dates as mdates
+        _MPL = (plt, mdates)
+    return _MPL
+
+
+def _smooth_curve(dts: List[datetime], ys: np.ndarray, n_points: int = 200):
+    _, mdates = _mpl()
+    # даты остаются float64 (точность), значения — float32: для PNG этого хватает
+    x = mdates.date2num(dts).astype(np.float64)
+    y = ys.astype(np.float32)
 
-    x = np.array(uniq_x, dtype=float)
-    y = np.array(uniq_y, dtype=float)
+    # усредняем точки с одинаковой датой (np.unique уже сортирует)
+    x, inv = np.unique(x, return_inverse=True)
+    y = (np.bincount(inv, weights=y) / np.bincount(inv)).astype(np.float32)
 
     if x.size <= 1:
         return x, y
 
     x_new = np.linspace(x.min(), x.max(), int(max(50, n_points)))
 
-    # 1) try SciPy cubic spline (best)
-    try:
-        from scipy.interpolate import make_interp_spline  # type: ignore
-        if x.size >= 4:
-            spl = make_interp_spline(x, y, k=3)
-            y_new = spl(x_new)
-        elif x.size == 3:
-            spl = make_interp_spline(x, y, k=2)
-            y_new = spl(x_new)
-        else:
-            y_new = np.interp(x_new, x, y)
-        return x_new, y_new
-    except Exception:
-        pass
+    if x.size >= 5:
+        try:
+            from scipy.signal import savgol_filter  # type: ignore
+            y = savgol_filter(y, window_length=5, polyorder=2)
+        except ImportError:
+            pass
 
-    # 2) fallback: polynomial fit (safe-ish)
-    deg = 3 if x.size >= 4 else (2 if x.size == 3 else 1)
-    try:
-        coeff = np.polyfit(x, y, deg)
-        y_new = np.polyval(coeff, x_new)
-        return x_new, y_new
-    except Exception:
-        y_new = np.interp(x_new, x, y)
-        return x_new, y_new
+    return x_new, np.interp(x_new, x, y).astype(np.float32)
 
 
-def _build_chart_png(gas: str, region_name: str, year: int, unit: str,
-                     points: List[Tuple[datetime, float]], lookback_days: int) -> bytes:
-    dts = [dt for dt, _ in points]
-    y = np.array([v for _, v in points], dtype=float)
+# фигура на каждый период графика; между вызовами меняем только данные линии
+_FIG_POOL: Dict[int, tuple] = {}
+
 
-    x_s, y_s = _smooth_curve(dts, y, n_points=500)
+def _chart_figure(lookback_days: int):
+    hit = _FIG_POOL.get(lookback_days)
+    if hit is not None:
+        return hit
 
-    fig = plt.figure(figsize=(12, 5.5), dpi=170)
+    plt, mdates = _mpl()
+    fig = plt.figure(figsize=(12, 5.5), dpi=CHART_DPI)
     ax = fig.add_subplot(111)
 
-    ax.plot(mdates.num2date(x_s), y_s, linewidth=2.7)
+    line, = ax.plot([], [], linewidth=2.7)
+    ax.xaxis_date()
 
-    ax.set_title(f"{gas} — {region_name} {year}")
-    ax.set_ylabel(f"Mean ({unit})")
     ax.grid(True, alpha=0.25, linestyle="--", linewidth=0.8)
 
     ax.spines["top"].set_visible(False)
     ax.spines["right"].set_visible(False)
 
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%m.%d"))
-    if lookback_days == 7:
-        ax.set_xticks(dts)
-    elif lookback_days == 15:
+    if lookback_days == 15:
         ax.xaxis.set_major_locator(mdates.DayLocator(interval=2))
-    else:
+    elif lookback_days != 7:
         ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=6, maxticks=15))
 
+    hit = (fig, ax, line)
+    _FIG_POOL[lookback_days] = hit
+    return hit
+
+
+def _build_chart_png(gas: str, region_name: str, year: int, unit: str,
+                     points: List[Tuple[datetime, float]], lookback_days: int) -> bytes:
+    dts = [dt for dt, _ in points]
+    y = np.array([v for _, v in points], dtype=np.float32)
+
+    x_s, y_s = _smooth_curve(dts, y, n_points=200)
+
+    fig, ax, line = _chart_figure(lookback_days)
+
+    line.set_data(x_s, y_s)
+    ax.relim()
+    ax.autoscale_view()
+
+    ax.set_title(f"{gas} — {region_name} {year}")
+    ax.set_ylabel(f"Mean ({unit})")
+
+    if lookback_days == 7:
+        ax.set_xticks(dts)
+
     fig.autofmt_xdate(rotation=0, ha="center")
 
-    import io
     buf = io.BytesIO()
     fig.tight_layout()
-    fig.savefig(buf, format="png")
-    plt.close(fig)
+    fig.savefig(buf, format="png", dpi=CHART_DPI, pil_kwargs={"compress_level": 3})
     return buf.getvalue()
 
 
@@ -237,12 +317,11 @@ def make_grafik(gas: str, date_str: str, parent_cod: int,
     start_dt = end_dt - timedelta(days=int(lookback_days) - 1)
     year = end_dt.year
 
-    ds_vec, lyr = _open_layer(mintaqa_shp)
-    vec_srs = lyr.GetSpatialRef()
+    _, lyr, vec_srs, fid_by_cod = _cached_layer(mintaqa_shp)
     if vec_srs is None:
         raise RuntimeError("У MINTAQA_SHP нет Spatial Reference (prj).")
 
-    feat, region_name = _get_feature_and_name(lyr, parent_cod)
+    feat, region_name = _get_feature_and_name(lyr, fid_by_cod, parent_cod)
     geom = feat.GetGeometryRef()
     if geom is None:
         raise RuntimeError(f"У parent_cod={parent_cod} нет геометрии")
@@ -266,12 +345,30 @@ def make_grafik(gas: str, date_str: str, parent_cod: int,
 
     selected = _dedupe_by_date(selected)
 
-    points: List[Tuple[datetime, float]] = []
-    for dt, tif_path in selected:
-        da = rioxarray.open_rasterio(tif_path).squeeze()
-        poly_geo = _geom_to_raster_geojson(geom, vec_srs, da.rio.crs)
-        clipped = da.rio.clip([poly_geo], drop=True)
-        points.append((dt, _compute_mean(gas, clipped.values.flatten())))
+    # у всех дат газа одна сетка пикселей -> полигон растеризуем в маску один раз
+    region_by_grid: Dict[tuple, tuple] = {}
+    region_lock = threading.Lock()
+
+    def region_idx(src) -> tuple:
+        grid = (src.crs.to_wkt() if src.crs else "", tuple(src.transform), src.shape)
+        with region_lock:  # OGR-геометрия не потокобезопасна
+            region = region_by_grid.get(grid)
+            if region is None:
+                region = _region_window(geom, vec_srs, src)
+                region_by_grid[grid] = region
+        return region
+
+    # чтение tif — IO/GDAL, GIL отпускается -> читаем параллельно
+    paths = [p for _, p in selected]
+    n_threads = min(READ_THREADS, len(paths))
+    batches = [paths[i::n_threads] for i in range(n_threads)]
+    with ThreadPoolExecutor(max_workers=n_threads) as ex:
+        batch_means = list(ex.map(lambda batch: _read_batch(batch, gas, region_idx), batches))
+    # раскладываем обратно в порядок selected (пачки шли через шаг n_threads)
+    means = [0.0] * len(paths)
+    for i, values in enumerate(batch_means):
+        means[i::n_threads] = values
+    points: List[Tuple[datetime, float]] = [(dt, v) for (dt, _), v in zip(selected, means)]
 
     png_bytes = _build_chart_png(
         gas=gas,
@@ -286,5 +383,4 @@ def make_grafik(gas: str, date_str: str, parent_cod: int,
     with open(out_path, "wb") as f:
         f.write(png_bytes)
 
-    ds_vec = None
     return {"png": out_path, "region_name": region_name}
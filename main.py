@@ -1,22 +1,37 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import json
+import uuid
+import atexit
+import shutil
 import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import lru_cache
 from datetime import datetime
 
+from PIL import Image
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.enum.style import WD_STYLE_TYPE
 
-from screen import make_screens
+from screen import make_screens, new_screen_canvas  # screen ставит backend Agg до старта пула
 from word_grafik import make_grafik
 
 
 # ====== CONFIG (лучше вынести в .env, но можно так) ======
 PIC_W = Inches(6.5)
+PIC_MAX_PX = 1300  # 6.5" x 200 dpi
 FONT_NAME = "Times New Roman"
 FONT_SIZE = 14
 
+# один tmp на процесс; build_docx работает в своей подпапке и чистит только её
+KEEP_TMP = os.environ.get("DEBUG") == "1"  # оставить png для отладки
+_TMPDIR = tempfile.mkdtemp(prefix="airrep_")
+if not KEEP_TMP:
+    atexit.register(shutil.rmtree, _TMPDIR, ignore_errors=True)
+
 UZ_MONTHS = {
     1: "yanvar", 2: "fevral", 3: "mart", 4: "aprel", 5: "may", 6: "iyun",
     7: "iyul", 8: "avgust", 9: "sentabr", 10: "oktabr", 11: "noyabr", 12: "dekabr"
@@ -28,47 +43,67 @@ def _uz_date(date_str: str) -> str:
     return f"{d.year}-yil {d.day}-{UZ_MONTHS[d.month]}"
 
 
-def _load_json(path: str) -> dict:
+@lru_cache(maxsize=16)
+def _load_json_cached(path: str, mtime: float) -> dict:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
+def _load_json(path: str) -> dict:
+    # mtime в ключе: поправили text.json -> перечитаем
+    return _load_json_cached(path, os.path.getmtime(path))
+
+
+STYLE_CENTER_BOLD = "CenterBold"
+STYLE_LEFT = "BodyLeft"
+STYLE_JUSTIFY = "BodyJustify"
+
+
 def _set_default_style(doc: Document):
     st = doc.styles["Normal"]
     st.font.name = FONT_NAME
     st.font.size = Pt(FONT_SIZE)
 
+    # форматирование задаём один раз в стилях, абзацы только ссылаются на них
+    for name, align, bold in (
+        (STYLE_CENTER_BOLD, WD_ALIGN_PARAGRAPH.CENTER, True),
+        (STYLE_LEFT, WD_ALIGN_PARAGRAPH.LEFT, None),
+        (STYLE_JUSTIFY, WD_ALIGN_PARAGRAPH.JUSTIFY, None),  # 🔹 по ширине
+    ):
+        ps = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+        ps.base_style = st
+        ps.paragraph_format.alignment = align
+        ps.font.bold = bold
+
 
 def _p_center_bold(doc: Document, text: str):
-    p = doc.add_paragraph()
-    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    r = p.add_run(text)
-    r.bold = True
-    r.font.name = FONT_NAME
-    r.font.size = Pt(FONT_SIZE)
-    return p
+    return doc.add_paragraph(text, style=STYLE_CENTER_BOLD)
 
 
 def _p_left(doc: Document, text: str):
-    p = doc.add_paragraph(text)
-    p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-    for r in p.runs:
-        r.font.name = FONT_NAME
-        r.font.size = Pt(FONT_SIZE)
-    return p
+    return doc.add_paragraph(text, style=STYLE_LEFT)
+
 
 def _p_justify(doc: Document, text: str):
-    p = doc.add_paragraph(text)
-    p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY  # 🔹 по ширине
-    for r in p.runs:
-        r.font.name = FONT_NAME
-        r.font.size = Pt(FONT_SIZE)
-    return p
+    return doc.add_paragraph(text, style=STYLE_JUSTIFY)
+
+
+def _fit_picture(path: str):
+    # Word всё равно показывает 6.5": лишние пиксели только раздувают docx
+    with Image.open(path) as im:
+        if im.width <= PIC_MAX_PX:
+            return path
+        h = round(im.height * PIC_MAX_PX / im.width)
+        buf = io.BytesIO()
+        im.resize((PIC_MAX_PX, h), Image.LANCZOS).save(buf, format="PNG")
+    buf.seek(0)
+    return buf
+
 
 def _add_picture_center(doc: Document, path: str, width=PIC_W):
     p = doc.add_paragraph()
     p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p.add_run().add_picture(path, width=width)
+    p.add_run().add_picture(_fit_picture(path), width=width)
     return p
 
 
@@ -78,6 +113,55 @@ def _add_multiline(doc: Document, text: str):
 
 
 
+_WORKER_CANVAS = None
+
+# Пул рендера живёт весь процесс: воркеры и их кэши (canvas, слои shp,
+# границы, фигуры графика) переиспользуются между газами и вызовами build_docx.
+# На Windows (spawn) каждый новый воркер заново импортирует GDAL/rasterio/matplotlib.
+REPORT_WORKERS = min(4, os.cpu_count() or 1)
+_RENDER_POOL = None
+
+
+def _render_pool() -> ProcessPoolExecutor:
+    global _RENDER_POOL
+    if _RENDER_POOL is None:
+        _RENDER_POOL = ProcessPoolExecutor(max_workers=REPORT_WORKERS)
+        atexit.register(_RENDER_POOL.shutdown)
+    return _RENDER_POOL
+
+
+def _render_gas(gas, date_str, parent_cod, rasters_root, mintaqa_shp, tuman_shp,
+                out_dir, count_gase):
+    # выполняется в процессе пула; фигура для скринов — одна на процесс
+    global _WORKER_CANVAS
+    if _WORKER_CANVAS is None:
+        _WORKER_CANVAS = new_screen_canvas()
+
+    # 1) Screens (2 png)
+    screens = make_screens(
+        gas=gas,
+        date_str=date_str,
+        parent_cod=parent_cod,
+        rasters_root=rasters_root,
+        vector_path=mintaqa_shp,         # <-- один и тот же shp
+        base_vector_path=tuman_shp,
+        out_dir=out_dir,
+        canvas=_WORKER_CANVAS,
+    )
+
+    # 2) Grafik (1 png)
+    grafik = make_grafik(
+        gas=gas,
+        date_str=date_str,
+        parent_cod=parent_cod,
+        rasters_root=rasters_root,
+        mintaqa_shp=mintaqa_shp,         # <-- тот же shp
+        out_dir=out_dir,
+        lookback_days=count_gase,
+    )
+    return screens, grafik
+
+
 def build_docx(
     gases,
     date_str: str,
@@ -109,37 +193,33 @@ def build_docx(
 
     os.makedirs(os.path.dirname(out_docx), exist_ok=True)
 
-    with tempfile.TemporaryDirectory(prefix="airrep_") as tmpdir:
+    tmpdir = os.path.join(_TMPDIR, uuid.uuid4().hex[:8])
+    os.makedirs(tmpdir)
+    try:
+        # газы независимы -> png считаем параллельно, docx собираем по порядку
+        ex = _render_pool()
+        futs = [
+            ex.submit(_render_gas, gas, date_str, parent_cod, rasters_root,
+                      mintaqa_shp, tuman_shp, tmpdir, count_gase)
+            for gas in gases
+        ]
+        try:
+            rendered = [f.result() for f in futs]
+        except BaseException:
+            # остальные воркеры ещё пишут png в tmpdir -> дождаться их до rmtree
+            for f in futs:
+                f.cancel()
+            wait(futs)
+            raise
+
         doc = Document()
         _set_default_style(doc)
 
-        for idx, gas in enumerate(gases, start=1):
+        for idx, (gas, (screens, grafik)) in enumerate(zip(gases, rendered), start=1):
             info = gas_db.get(gas, {})
             gas_name = info.get("display_uz", gas)
             unit = info.get("unit", "")
             text_tpl = info.get("text_uz", "")
-
-            # 1) Screens (2 png)
-            screens = make_screens(
-                gas=gas,
-                date_str=date_str,
-                parent_cod=parent_cod,
-                rasters_root=rasters_root,
-                vector_path=mintaqa_shp,         # <-- один и тот же shp
-                base_vector_path=tuman_shp,
-                out_dir=tmpdir,
-            )
-
-            # 2) Grafik (1 png)
-            grafik = make_grafik(
-                gas=gas,
-                date_str=date_str,
-                parent_cod=parent_cod,
-                rasters_root=rasters_root,
-                mintaqa_shp=mintaqa_shp,         # <-- тот же shp
-                out_dir=tmpdir,
-                lookback_days=count_gase,
-            )
             region_name = grafik.get("region_name") or str(parent_cod)
 
             # ===== PAGE 1: республика png -> график =====
@@ -168,6 +248,9 @@ def build_docx(
                 doc.add_page_break()
 
         doc.save(out_docx)
+    finally:
+        if not KEEP_TMP:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
     return out_docx
 
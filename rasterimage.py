@@ -5,9 +5,12 @@ from datetime import datetime
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap, Normalize, ListedColormap
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.figure import Figure
+from matplotlib.colors import LinearSegmentedColormap, Normalize
 from matplotlib.patches import Rectangle
+from matplotlib.collections import LineCollection
 from osgeo import gdal, ogr, osr
 import matplotlib.colors as mcolors
 
@@ -27,7 +30,6 @@ GAS_UNITS = {
 LEGEND_SCALE = {"CH4": 1 / 1000}
 
 DISPLAY_INTERP_MAIN = "bicubic"
-DISPLAY_INTERP_ZERO = "bicubic"
 ZOOM_PAD = 0.10
 
 BASE_COLOR = "#111111"
@@ -40,8 +42,13 @@ LEGEND_TICKS = 3
 
 ZERO_COLOR = "#ff00ff"
 
+# в Word картинка идёт шириной 6.5", 8" x 150 dpi = 1200 px хватает с запасом
+SCREEN_FIGSIZE = (8, 6)
+SCREEN_DPI = 150
+
 PCLIP_LOW = 2.0
 PCLIP_HIGH = 98.0
+PCLIP_BINS = 16384
 
 
 def _spectrum_cmap():
@@ -53,6 +60,37 @@ def _spectrum_cmap():
     return LinearSegmentedColormap.from_list("spectrum", cols, N=256)
 
 
+_SPECTRUM_CMAP = _spectrum_cmap()
+_ZERO_RGBA = tuple(int(round(c * 255)) for c in mcolors.to_rgba(ZERO_COLOR, 1.0))
+
+
+def _percent_clip(v, p_low, p_high, bins):
+    # перцентили через гистограмму: O(n) вместо сортировки в np.percentile.
+    # Бин лишь сужает поиск, само значение берём np.partition по элементам бина —
+    # результат как у np.percentile (linear), даже если бин грубее данных.
+    vmin, vmax = float(v.min()), float(v.max())
+    if vmax <= vmin:
+        return vmin, vmax
+    idx = ((v - vmin) * (bins / (vmax - vmin))).astype(np.int64)
+    np.minimum(idx, bins - 1, out=idx)
+    cdf = np.cumsum(np.bincount(idx, minlength=bins))
+
+    def order_stat(k):
+        b = int(np.searchsorted(cdf, k, side="right"))  # первый бин, где cdf > k
+        k_in_bin = k - (int(cdf[b - 1]) if b else 0)
+        return float(np.partition(v[idx == b], k_in_bin)[k_in_bin])
+
+    def percentile(p):
+        rank = (v.size - 1) * p / 100.0
+        k = int(rank)
+        lo = order_stat(k)
+        if rank == k:
+            return lo
+        return lo + (order_stat(k + 1) - lo) * (rank - k)
+
+    return percentile(p_low), percentile(p_high)
+
+
 def _srs_axis(srs, fallback_epsg=None):
     if srs is None:
         srs = osr.SpatialReference()
@@ -96,36 +134,98 @@ def _get_feature_by_parent_cod(lyr, parent_cod):
 
 def _layer_extent_in_raster_srs(lyr, ct):
     xmin, xmax, ymin, ymax = lyr.GetExtent()
-    pts = ((xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax))
-    xs, ys = [], []
-    for x, y in pts:
-        p = ogr.Geometry(ogr.wkbPoint)
-        p.AddPoint(x, y)
-        if ct:
-            p.Transform(ct)
-        xs.append(p.GetX())
-        ys.append(p.GetY())
+    pts = [(xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax)]
+    out = ct.TransformPoints(pts) if ct else pts
+    xs = [p[0] for p in out]
+    ys = [p[1] for p in out]
     return min(xs), max(xs), min(ys), max(ys)
 
 
-def _plot_geom(ax, geom, inv_gt, color, lw, z):
-    def draw_ring(ring):
-        xs, ys = [], []
-        for (x, y, *_) in ring.GetPoints():
-            c, r = gdal.ApplyGeoTransform(inv_gt, x, y)
-            xs.append(c)
-            ys.append(r)
-        ax.plot(xs, ys, color=color, linewidth=lw, zorder=z)
+def _to_pixels(pts, inv_gt):
+    # то же, что gdal.ApplyGeoTransform, но сразу для всех вершин
+    a, b, c, d, e, f = inv_gt
+    return np.column_stack((a + pts[:, 0] * b + pts[:, 1] * c,
+                            d + pts[:, 0] * e + pts[:, 1] * f))
+
 
+def _ring_points(ring):
+    return np.asarray(ring.GetPoints(), dtype=np.float64)[:, :2]
+
+
+def _geom_rings(geom):
     gt = geom.GetGeometryType()
     if gt in (ogr.wkbPolygon, ogr.wkbPolygon25D):
         for i in range(geom.GetGeometryCount()):
-            draw_ring(geom.GetGeometryRef(i))
+            yield geom.GetGeometryRef(i)
     elif gt in (ogr.wkbMultiPolygon, ogr.wkbMultiPolygon25D):
         for pi in range(geom.GetGeometryCount()):
             poly = geom.GetGeometryRef(pi)
             for ri in range(poly.GetGeometryCount()):
-                draw_ring(poly.GetGeometryRef(ri))
+                yield poly.GetGeometryRef(ri)
+
+
+def _geom_segments(geom, inv_gt):
+    return [_to_pixels(_ring_points(r), inv_gt) for r in _geom_rings(geom) if r.GetPointCount() > 0]
+
+
+def _layer_segments(lyr, ct, inv_gt):
+    # вершины всех колец слоя без Clone/Transform геометрий:
+    # один TransformPoints на весь слой, потом аффинное в пиксели и разрезка по кольцам
+    rings = []
+    lyr.ResetReading()
+    for f in lyr:
+        g = f.GetGeometryRef()
+        if not g:
+            continue
+        rings.extend(_ring_points(r) for r in _geom_rings(g) if r.GetPointCount() > 0)
+    lyr.ResetReading()
+    if not rings:
+        return []
+
+    pts = np.concatenate(rings)
+    if ct:
+        pts = np.asarray(ct.TransformPoints(pts.tolist()), dtype=np.float64)[:, :2]
+    px = _to_pixels(pts, inv_gt)
+    return np.split(px, np.cumsum([len(r) for r in rings])[:-1])
+
+
+def _segments_bounds(segments):
+    # (xmin, xmax, ymin, ymax) каждого кольца — для отсева по виду
+    if not segments:
+        return np.empty((0, 4))
+    return np.array([(s[:, 0].min(), s[:, 0].max(), s[:, 1].min(), s[:, 1].max()) for s in segments])
+
+
+def _segments_in_view(segments, bounds, xmin, xmax, ymin, ymax):
+    keep = ((bounds[:, 1] >= xmin) & (bounds[:, 0] <= xmax) &
+            (bounds[:, 3] >= ymin) & (bounds[:, 2] <= ymax))
+    return [segments[i] for i in np.flatnonzero(keep)]
+
+
+# кольца Tuman уже в пикселях растра; у всех газов одна сетка -> читаем shp один раз.
+# Векторы переводим в СК растра, а не растр (gdal.Warp) в СК векторов: проекция
+# вершин делается один раз на отчёт, а Warp пришлось бы делать на каждый газ
+# и он пересэмплирует данные до расчёта перцентилей.
+_BASE_RINGS_CACHE = {}
+
+
+def _load_base_rings(base_vector_path, ras_srs, inv_gt):
+    key = (base_vector_path, os.path.getmtime(base_vector_path), ras_srs.ExportToWkt(), tuple(inv_gt))
+    hit = _BASE_RINGS_CACHE.get(key)
+    if hit is None:
+        bds = ogr.Open(base_vector_path)
+        blyr = bds.GetLayer(0)
+        b_srs = _srs_axis(blyr.GetSpatialRef(), fallback_epsg=3857)
+        bct = osr.CoordinateTransformation(b_srs, ras_srs) if not b_srs.IsSame(ras_srs) else None
+        segments = _layer_segments(blyr, bct, inv_gt)
+        hit = (segments, _segments_bounds(segments))
+        _BASE_RINGS_CACHE[key] = hit
+    return hit
+
+
+def _plot_geom(ax, geom, inv_gt, color, lw, z):
+    for seg in _geom_segments(geom, inv_gt):
+        ax.plot(seg[:, 0], seg[:, 1], color=color, linewidth=lw, zorder=z)
 
 
 def _add_legend(fig, ax, cmap, vmin_raw, vmax_raw, title, scale=1.0):
@@ -138,7 +238,7 @@ def _add_legend(fig, ax, cmap, vmin_raw, vmax_raw, title, scale=1.0):
     w, h = 0.22, 0.02
 
     cax = fig.add_axes([left, bottom, w, h])
-    sm = plt.cm.ScalarMappable(norm=Normalize(vmin=vmin_raw, vmax=vmax_raw), cmap=cmap)
+    sm = ScalarMappable(norm=Normalize(vmin=vmin_raw, vmax=vmax_raw), cmap=cmap)
     sm.set_array([])
     cb = fig.colorbar(sm, cax=cax, orientation="horizontal")
     cb.set_ticks(ticks)
@@ -154,13 +254,26 @@ def _add_legend(fig, ax, cmap, vmin_raw, vmax_raw, title, scale=1.0):
     nd_ax.axis("off")
     nd_ax.add_patch(Rectangle((0, 0), 1, 1, transform=nd_ax.transAxes,
                               facecolor=ZERO_COLOR, edgecolor="none"))
-    fig.text(left + w + pad + box_w + 0.004, bottom + h / 2,
-             "NoData", va="center", ha="left", fontsize=9)
+    nd_txt = fig.text(left + w + pad + box_w + 0.004, bottom + h / 2,
+                      "NoData", va="center", ha="left", fontsize=9)
+    return [cax, nd_ax, nd_txt]
+
+
+def new_screen_canvas():
+    # одна фигура на весь отчёт: make_screens(..., canvas=...) только перерисовывает ax
+    # Figure + свой Agg-канвас без pyplot: буфер рендера переиспользуется между png
+    fig = Figure(figsize=SCREEN_FIGSIZE, dpi=SCREEN_DPI)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot(111)
+
+
+def release_screen_canvas(canvas):
+    canvas[0].clear()
 
 
 def make_screens(gas, date_str, parent_cod,
                  rasters_root, vector_path, base_vector_path,
-                 out_dir):
+                 out_dir, canvas=None):
 
     gas = gas.upper()
     os.makedirs(out_dir, exist_ok=True)
@@ -168,23 +281,28 @@ def make_screens(gas, date_str, parent_cod,
     tif_path = _find_raster(rasters_root, gas, date_str)
     ds = gdal.Open(tif_path)
     band = ds.GetRasterBand(1)
-    arr = band.ReadAsArray().astype(np.float32)
+    arr = band.ReadAsArray(buf_type=gdal.GDT_Float32)  # GDAL сразу пишет float32, без astype-копии
 
     zero_mask = (arr == 0.0)
 
-    valid = np.isfinite(arr) & (~zero_mask)
+    # fill-значения NetCDF/GRIB (~9.97e36) не данные — как в graph.py, режем >= 1e20
+    valid = np.isfinite(arr) & (~zero_mask) & (arr < 1e20)
     if not np.any(valid):
         vmin_clip, vmax_clip = 0.0, 1.0
     else:
-        v = arr[valid]
-        vmin_clip = float(np.percentile(v, PCLIP_LOW))
-        vmax_clip = float(np.percentile(v, PCLIP_HIGH))
+        vmin_clip, vmax_clip = _percent_clip(arr[valid], PCLIP_LOW, PCLIP_HIGH, PCLIP_BINS)
         if vmax_clip == vmin_clip:
             vmax_clip = vmin_clip + 1e-12
 
-    norm = np.clip((arr - vmin_clip) / (vmax_clip - vmin_clip), 0.0, 1.0)
+    # нормализация на месте + готовая RGBA-картинка: imshow не гоняет float64 на каждом рендере
+    norm = arr - np.float32(vmin_clip)
+    norm *= np.float32(1.0 / (vmax_clip - vmin_clip))
+    np.clip(norm, 0.0, 1.0, out=norm)
 
-    cmap = _spectrum_cmap()
+    cmap = _SPECTRUM_CMAP
+    rgba = cmap(norm, bytes=True)
+    del norm
+    rgba[zero_mask] = _ZERO_RGBA  # NoData прямо в картинку, без второго imshow
     inv_gt = _inv_gt(ds)
     W, H = ds.RasterXSize, ds.RasterYSize
 
@@ -197,13 +315,15 @@ def make_screens(gas, date_str, parent_cod,
     scale = LEGEND_SCALE.get(gas, 1.0)
     legend_title = f"{gas} Konsentratsiyasi ({unit})"
 
-    zero_layer = np.where(zero_mask, 1, 0).astype(np.uint8)
-    zero_cmap = ListedColormap([(0, 0, 0, 0), mcolors.to_rgba(ZERO_COLOR, 1.0)])
+    base_segments, base_bounds = _load_base_rings(base_vector_path, ras_srs, inv_gt)
+
+    vds = ogr.Open(vector_path)
+    lyr = vds.GetLayer(0)
+    vec_srs = _srs_axis(lyr.GetSpatialRef(), fallback_epsg=3857)
+    ct = osr.CoordinateTransformation(vec_srs, ras_srs) if not vec_srs.IsSame(ras_srs) else None
 
-    bds = ogr.Open(base_vector_path)
-    blyr = bds.GetLayer(0)
-    b_srs = _srs_axis(blyr.GetSpatialRef(), fallback_epsg=3857)
-    bct = osr.CoordinateTransformation(b_srs, ras_srs) if not b_srs.IsSame(ras_srs) else None
+    own_canvas = canvas is None
+    fig, ax = new_screen_canvas() if own_canvas else canvas
 
     def clamp_view(ax, x0, x1, y0, y1):
         xmin = max(0.0, min(x0, x1))
@@ -216,16 +336,18 @@ def make_screens(gas, date_str, parent_cod,
             ymin, ymax = 0.0, float(H)
         ax.set_xlim(xmin, xmax)
         ax.set_ylim(ymax, ymin)
+        return xmin, xmax, ymin, ymax
 
-    def render_one(mode, out_png, base_w, highlight):
-        fig, ax = plt.subplots(figsize=(10, 8))
-        ax.imshow(norm, cmap=cmap, interpolation=DISPLAY_INTERP_MAIN, zorder=0)
-        ax.imshow(zero_layer, cmap=zero_cmap, interpolation=DISPLAY_INTERP_ZERO, zorder=2)
+    def view_window(xmin, xmax, ymin, ymax, margin=2):
+        # окно пикселей под видом (+ запас под bicubic) и его extent в координатах полного растра
+        c0 = max(0, int(np.floor(xmin)) - margin)
+        c1 = min(W, int(np.ceil(xmax)) + margin)
+        r0 = max(0, int(np.floor(ymin)) - margin)
+        r1 = min(H, int(np.ceil(ymax)) + margin)
+        return (slice(r0, r1), slice(c0, c1)), (c0 - 0.5, c1 - 0.5, r1 - 0.5, r0 - 0.5)
 
-        vds = ogr.Open(vector_path)
-        lyr = vds.GetLayer(0)
-        vec_srs = _srs_axis(lyr.GetSpatialRef(), fallback_epsg=3857)
-        ct = osr.CoordinateTransformation(vec_srs, ras_srs) if not vec_srs.IsSame(ras_srs) else None
+    def render_one(mode, out_png, base_w, highlight):
+        ax.cla()
 
         if mode == "feature":
             feat = _get_feature_by_parent_cod(lyr, parent_cod)
@@ -243,32 +365,35 @@ def make_screens(gas, date_str, parent_cod,
 
         x0, y0 = gdal.ApplyGeoTransform(inv_gt, xmin, ymin)
         x1, y1 = gdal.ApplyGeoTransform(inv_gt, xmax, ymax)
-        clamp_view(ax, x0, x1, y0, y1)
-
-        blyr.ResetReading()
-        for bf in blyr:
-            bg = bf.GetGeometryRef()
-            if not bg:
-                continue
-            bg = bg.Clone()
-            if bct:
-                bg.Transform(bct)
-            _plot_geom(ax, bg, inv_gt, BASE_COLOR, base_w, z=3)
+        view = clamp_view(ax, x0, x1, y0, y1)
+        win, extent = view_window(*view)
+
+        ax.imshow(rgba[win], interpolation=DISPLAY_INTERP_MAIN, extent=extent, zorder=0)
+
+        # все границы туманов — одним артистом
+        visible = _segments_in_view(base_segments, base_bounds, *view)
+        ax.add_collection(LineCollection(visible, colors=BASE_COLOR, linewidths=base_w, zorder=3))
 
         if highlight and g_sel is not None:
             _plot_geom(ax, g_sel, inv_gt, SEL_COLOR, SEL_W * 1.6, z=8)
             _plot_geom(ax, g_sel, inv_gt, SEL_COLOR, SEL_W, z=9)
 
         ax.axis("off")
-        fig.subplots_adjust(bottom=0.18)
-        _add_legend(fig, ax, cmap, vmin_clip, vmax_clip, legend_title, scale)
-        fig.savefig(out_png, dpi=200, bbox_inches="tight", pad_inches=0)
-        plt.close(fig)
+        # фиксированная раскладка вместо bbox_inches="tight" (лишний проход рендера)
+        fig.subplots_adjust(left=0.02, right=0.98, top=0.98, bottom=0.18)
+        legend = _add_legend(fig, ax, cmap, vmin_clip, vmax_clip, legend_title, scale)
+        fig.canvas.print_png(out_png)
+        for artist in legend:
+            artist.remove()
 
     out_rayon = os.path.join(out_dir, f"{gas}_{date_str}_rayon_screen.png")
     out_mintaqa = os.path.join(out_dir, f"{gas}_{date_str}_mintaqa_screen.png")
 
-    render_one("feature", out_rayon, BASE_W_RAYON, True)
-    render_one("layer", out_mintaqa, BASE_W_MINTAQA, False)
+    try:
+        render_one("feature", out_rayon, BASE_W_RAYON, True)
+        render_one("layer", out_mintaqa, BASE_W_MINTAQA, False)
+    finally:
+        if own_canvas:
+            release_screen_canvas((fig, ax))
 
     return {"rayon": out_rayon, "mintaqa": out_mintaqa, "raster": tif_path}
@@ -1,6 +1,8 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 
 import xarray as xr
 import rioxarray  # чтобы заработал .rio у DataArray
@@ -23,6 +25,15 @@ TOP_LAT    = 48
 
 BASE_URL = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
 
+DOWNLOAD_CHUNK = 1 << 20       # 1 MB
+IN_MEMORY_LIMIT = 16 << 20     # меньше — пишем ответ одним write
+
+DOWNLOAD_WORKERS = 8  # параллельные запросы к NOMADS
+
+# одна сессия = keep-alive, без нового TCP/TLS на каждый час
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS))
+
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
@@ -78,18 +89,36 @@ def convert_grib_to_tif_cfgrib(in_path: str, out_path: str):
         print(f"    ❌ Ошибка записи TIF: {e}")
 
 
+def fetch_grib(day: date, forecast_hour: int, out_path: str) -> bool:
+    base_url, params = build_gfs_url(day, RUN_HOUR, forecast_hour)
+    resp = SESSION.get(base_url, params=params, stream=True)
+
+    if resp.status_code != 200:
+        print(f"    ❌ f{forecast_hour:03d} HTTP {resp.status_code}: {resp.text[:200]}")
+        return False
+
+    size = int(resp.headers.get("Content-Length") or 0)
+    with open(out_path, "wb") as f:
+        if 0 < size < IN_MEMORY_LIMIT:
+            f.write(resp.content)
+        else:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                if chunk:
+                    f.write(chunk)
+
+    print(f"    ✔ GRIB временно сохранён: {out_path}")
+    return True
+
+
 def download_gfs_temp2m_for_day(day: date):
     print(f"\n=== {day} (run {RUN_HOUR:02d}Z) ===")
     date_str = day.strftime("%Y%m%d")
 
+    jobs = []
     for fh in FORECAST_HOURS:
         hour_str = f"{fh:02d}"
         fff = f"{fh:03d}"
 
-        print(f"  --- f{fff} ({hour_str}:00) ---")
-
-        base_url, params = build_gfs_url(day, RUN_HOUR, fh)
-
         tif_name = f"{date_str}_{hour_str}_GFS_temp.tif"
         tif_path = os.path.join(OUTPUT_DIR, tif_name)
 
@@ -99,31 +128,35 @@ def download_gfs_temp2m_for_day(day: date):
 
         tmp_grib_name = f"tmp_{date_str}_f{fff}.grib2"
         tmp_grib_path = os.path.join(OUTPUT_DIR, tmp_grib_name)
+        jobs.append((fh, tmp_grib_path, tif_path))
 
-        print("    -> Скачиваем GRIB2...")
-        resp = requests.get(base_url, params=params, stream=True)
-
-        if resp.status_code != 200:
-            print(f"    ❌ HTTP {resp.status_code}: {resp.text[:200]}")
-            continue
-
-        with open(tmp_grib_path, "wb") as f:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-
-        print(f"    ✔ GRIB временно сохранён: {tmp_grib_path}")
+    if not jobs:
+        return
 
-        try:
-            convert_grib_to_tif_cfgrib(tmp_grib_path, tif_path)
-        finally:
-            # Удаляем временный GRIB
-            if os.path.exists(tmp_grib_path):
-                try:
-                    os.remove(tmp_grib_path)
-                    print(f"    🗑 Удалён GRIB: {tmp_grib_path}")
-                except Exception as e:
-                    print(f"    ⚠ Ошибка удаления GRIB: {e}")
+    print(f"    -> Скачиваем GRIB2 ({len(jobs)} ч., {DOWNLOAD_WORKERS} потоков)...")
+
+    # качаем параллельно, конвертируем в основном потоке (cfgrib не потокобезопасен)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as ex:
+        futs = {ex.submit(fetch_grib, day, fh, tmp): (fh, tmp, tif) for fh, tmp, tif in jobs}
+        for fut in as_completed(futs):
+            fh, tmp_grib_path, tif_path = futs[fut]
+            try:
+                ok = fut.result()
+            except Exception as e:
+                print(f"    ❌ f{fh:03d}: {e}")
+                ok = False
+
+            try:
+                if ok:
+                    convert_grib_to_tif_cfgrib(tmp_grib_path, tif_path)
+            finally:
+                # Удаляем временный GRIB
+                if os.path.exists(tmp_grib_path):
+                    try:
+                        os.remove(tmp_grib_path)
+                        print(f"    🗑 Удалён GRIB: {tmp_grib_path}")
+                    except Exception as e:
+                        print(f"    ⚠ Ошибка удаления GRIB: {e}")
 
 
 
@@ -0,0 +1,28 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("rasterio")
+pytest.importorskip("shapely")
+pytest.importorskip("osgeo")
+
+from graph import _compute_mean
+
+
+def test_compute_mean_2d_masked_window():
+    values = np.array(
+        [[1.0, 2.0, np.nan],
+         [3.0, 9.97e36, 6.0]],
+        dtype=np.float32,
+    )
+    # nan и fill-значение не считаются: (1 + 2 + 3 + 6) / 4
+    assert _compute_mean("CO", values) == 3.0
+
+
+def test_compute_mean_matches_flat_input():
+    values = np.arange(12, dtype=np.float32).reshape(3, 4)
+    assert _compute_mean("NO2", values) == _compute_mean("NO2", values.ravel())
+
+
+def test_compute_mean_all_masked():
+    values = np.full((2, 2), np.nan, dtype=np.float32)
+    assert _compute_mean("CO", values) == 0.0
@@ -1,9 +1,26 @@
 import os
+import glob
+import tempfile
+import asyncio
+import logging
+import logging.handlers
+from typing import Dict, Optional
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, timedelta
-import requests
 
+import httpx
+
+try:
+    import h2  # noqa: F401 — нужен httpx для HTTP/2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+import cfgrib
+import numpy as np
+import rasterio
 import xarray as xr
-import rioxarray  # чтобы заработал .rio у DataArray
+from rasterio.transform import from_origin
 
 OUTPUT_DIR = r"D:\Xalim\wind_visual\ADS_GASES_test_2026_new\NOA_TEMP_WIND"
 
@@ -26,18 +43,104 @@ FORECAST_HOURS = list(range(0, 24))
 # Базовый URL GFS 0.25 (NOMADS grib-filter)
 BASE_URL = "https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl"
 
+# Сколько запросов к NOMADS одновременно (NOMADS режет ~120 запросов/мин)
+DOWNLOAD_CONCURRENCY = 8
+# Повторы при 429/5xx и обрывах соединения (пауза 1, 2, 4, ... с или Retry-After)
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Пул keep-alive соединений к NOMADS. С HTTP/2 все запросы мультиплексируются
+# в одном-двух соединениях, без h2 — обычный пул HTTP/1.1.
+HTTP_POOL_SIZE = 4 if HTTP2 else 16
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=20.0)
+# keep-alive у httpx по умолчанию, а заголовок Connection в HTTP/2 запрещён.
+# GRIB2 внутри уже сжат, так что gzip NOMADS скорее всего не применит — размеры
+# на проводе и после распаковки видны в логе, если сервер всё же сжал.
+HTTP_HEADERS = {"Accept-Encoding": "gzip, identity", "User-Agent": "AIR_Monitoring/1.0"}
+DOWNLOAD_CHUNK = 256 * 1024  # меньше итераций Python на файл, чем с 8 КБ
+
+# Дни качаются в отдельных процессах, в каждом — свой пул для cfgrib
+DAY_WORKERS = 4
+CONVERT_WORKERS = 2
+# DOWNLOAD_CONCURRENCY — общий бюджет на все процессы дней, а не на каждый:
+# NOMADS банит IP при превышении, 429-бэкофф от этого не спасает
+DAY_CONCURRENCY = max(1, DOWNLOAD_CONCURRENCY // DAY_WORKERS)
+
+# indexpath="" — cfgrib не пишет/не читает .idx рядом с временным GRIB.
+# cache_geo_coords (cfgrib >= 0.9.10.4) — lat/lon сетки 0.25° строятся один раз
+# на процесс, а не заново на каждый файл.
+CFGRIB_KWARGS = {"indexpath": ""}
+if tuple(int(x) for x in cfgrib.__version__.split(".")[:4] if x.isdigit()) >= (0, 9, 10, 4):
+    CFGRIB_KWARGS["cache_geo_coords"] = True
+
+# Общие параметры GeoTIFF: все файлы на одной сетке, DEFLATE+predictor для гладких полей.
+# num_threads не ставим: сетка 65x129 — один тайл, а процессов дней/конвертации и так много.
+TIF_PROFILE = {
+    "driver": "GTiff",
+    "count": 1,
+    "dtype": "float32",
+    "crs": "EPSG:4326",
+    "tiled": True,
+    "compress": "DEFLATE",
+    "predictor": 2,
+}
+
+# Хранение в int16 (значение = int16 * INT16_SCALE) — вдвое меньше float32.
+# Точность 0.01 м/с, масштаб пишется в теги TIFF как scale_factor.
+QUANTIZE_INT16 = False
+INT16_SCALE = 0.01
+INT16_NODATA = -32768
+
+PART_SUFFIX = ".part"
+
+# Лог копится в памяти и выводится пачкой: на границе дня/файла или сразу при ERROR.
+# Консоль Windows на каждом print заметно тормозит горячий цикл.
+LOG_BUFFER_RECORDS = 1024
+
+logger = logging.getLogger("wind_noa")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    _stream_handler = logging.StreamHandler()
+    _stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(logging.handlers.MemoryHandler(
+        LOG_BUFFER_RECORDS, flushLevel=logging.ERROR, target=_stream_handler))
+
+
+def flush_log():
+    for handler in logger.handlers:
+        handler.flush()
+
+
+def _drop_inherited_log():
+    # initializer пула: при fork воркер наследует чужой буфер записей дня —
+    # без очистки они напечатались бы повторно при первом flush_log()
+    for handler in logger.handlers:
+        if isinstance(handler, logging.handlers.BufferingHandler):
+            handler.acquire()
+            try:
+                handler.buffer.clear()
+            finally:
+                handler.release()
+
+
+# Временные GRIB для cfgrib — на быстрый диск (%TEMP% / RAM-диск), на D: только TIF
+GRIB_TMPDIR = os.environ.get("GRIB_TMPDIR", tempfile.gettempdir())
+TMP_GRIB_PREFIX = "air_wind_"
+
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+os.makedirs(GRIB_TMPDIR, exist_ok=True)
 
 
-def build_gfs_url(day: date, run_hour: int, forecast_hour: int, component: str):
+def build_gfs_url(day: date, run_hour: int, forecast_hour: int, components=("U", "V")):
     """
-    component: 'U' или 'V'
+    components: набор из 'U' и/или 'V' — оба идут одним запросом
     Собираем URL и параметры для запроса GFS 0.25:
     - gfs.YYYYMMDD/run_hour
     - gfs.t{HH}z.pgrb2.0p25.f{forecast_hour:03d}
-    - параметр UGRD или VGRD на 10 m above ground, bbox.
+    - параметры UGRD и/или VGRD на 10 m above ground, bbox.
     """
-    assert component in ("U", "V")
+    assert components and set(components) <= {"U", "V"}
 
     ymd = day.strftime("%Y%m%d")
     hh = f"{run_hour:02d}"
@@ -57,126 +160,311 @@ def build_gfs_url(day: date, run_hour: int, forecast_hour: int, component: str):
         "dir": directory,
     }
 
-    if component == "U":
+    if "U" in components:
         params["var_UGRD"] = "on"
-    else:
+    if "V" in components:
         params["var_VGRD"] = "on"
 
     return BASE_URL, params
 
 
-def convert_grib_to_tif_cfgrib(in_path: str, out_path: str):
-    """
-    Конвертация одного GRIB2 в GeoTIFF через xarray + cfgrib + rioxarray.
-    Оставляем значения в м/с.
-    """
-    print(f"      -> Конвертация в TIF: {os.path.basename(out_path)}")
-
-    try:
-        ds = xr.open_dataset(in_path, engine="cfgrib")
-    except Exception as e:
-        print(f"      ❌ Не удалось открыть GRIB через cfgrib: {e}")
-        return
-
-    if not ds.data_vars:
-        print("      ❌ В датасете нет переменных, пропускаем.")
-        return
+def _wind_component(var_name: str) -> Optional[str]:
+    # cfgrib называет их u10 / v10
+    name = var_name.lower()
+    if name.startswith("u"):
+        return "U"
+    if name.startswith("v"):
+        return "V"
+    return None
 
-    # Берём первую переменную (обычно ugrd10m или vgrd10m)
-    var_name = list(ds.data_vars.keys())[0]
-    da = ds[var_name].squeeze()
 
-    # CRS (широта/долгота)
-    if not da.rio.crs:
-        da = da.rio.write_crs("EPSG:4326")
+# Сетка у всех файлов одна (0.25° по тому же bbox) — профиль считаем один раз.
+# Ключ: размер и крайние координаты сетки.
+_PROFILE_CACHE: Dict[tuple, dict] = {}
 
-    try:
-        da.rio.to_raster(out_path)
-        print(f"      ✅ TIF сохранён: {out_path}")
-    except Exception as e:
-        print(f"      ❌ Ошибка при записи GeoTIFF: {e}")
 
+def _grid_profile(da: xr.DataArray) -> dict:
+    lat = da["latitude"].values
+    lon = da["longitude"].values
+    key = (lat.size, lon.size, float(lat[0]), float(lat[-1]), float(lon[0]), float(lon[-1]))
 
-def download_gfs_wind10m_for_day(day: date):
+    profile = _PROFILE_CACHE.get(key)
+    if profile is None:
+        # координаты cfgrib — центры пикселей, широта идёт сверху вниз
+        res_x = abs(float(lon[1] - lon[0]))
+        res_y = abs(float(lat[1] - lat[0]))
+        west = float(lon.min()) - res_x / 2
+        north = float(lat.max()) + res_y / 2
+        profile = dict(TIF_PROFILE, height=lat.size, width=lon.size,
+                       transform=from_origin(west, north, res_x, res_y))
+        _PROFILE_CACHE[key] = profile
 
-    print(f"\n=== Обработка даты {day} (run {RUN_HOUR:02d}Z) ===")
-    date_str = day.strftime("%Y%m%d")
+    # копия: вызывающий может дописать dtype/nodata
+    return dict(profile)
 
-    for fh in FORECAST_HOURS:
-        fff = f"{fh:03d}"
-        hour_str = f"{fh:02d}"
-        print(f"  --- Час прогноза f{fff} ({hour_str}:00) ---")
 
-        for component in ("U", "V"):
+def convert_grib_to_tif_cfgrib(in_path: str, out_paths: Dict[str, str]):
+    """
+    Конвертация одного GRIB2 (U и/или V) в GeoTIFF через xarray + cfgrib + rasterio.
+    out_paths: {'U': путь, 'V': путь} — каждая компонента в свой файл.
+    Оставляем значения в м/с.
+    """
+    names = ", ".join(os.path.basename(p) for p in out_paths.values())
+    logger.info(f"      -> Конвертация в TIF: {names}")
 
+    try:
+        ds = xr.open_dataset(in_path, engine="cfgrib", backend_kwargs=CFGRIB_KWARGS)
+    except Exception as e:
+        logger.error(f"      ❌ Не удалось открыть GRIB через cfgrib: {e}")
+        return
 
-            suffix = "U_GFS" if component == "U" else "V_GFS"
-            tif_name = f"{date_str}_{hour_str}_{suffix}.tif"
-            tif_path = os.path.join(OUTPUT_DIR, tif_name)
+    # закрываем сразу: иначе eccodes держит файл и на Windows os.remove падает
+    with ds:
+        if not ds.data_vars:
+            logger.error("      ❌ В датасете нет переменных, пропускаем.")
+            return
 
-            if os.path.exists(tif_path):
-                print(f"    ✔ {component}: TIF уже существует, пропускаем: {tif_path}")
+        for var_name in ds.data_vars:
+            out_path = out_paths.get(_wind_component(var_name))
+            if out_path is None:
                 continue
 
-            base_url, params = build_gfs_url(day, RUN_HOUR, fh, component=component)
+            # м/с не нужен float64
+            da = ds[var_name].squeeze().astype("float32")
+            arr = da.values
+            if da["latitude"].values[0] < da["latitude"].values[-1]:
+                arr = arr[::-1]
+
+            profile = _grid_profile(da)
+            tags = {}
+            if QUANTIZE_INT16:
+                missing = ~np.isfinite(arr)
+                q = np.clip(np.round(arr / INT16_SCALE), INT16_NODATA + 1, np.iinfo(np.int16).max)
+                arr = np.where(missing, INT16_NODATA, q).astype(np.int16)
+                profile.update(dtype="int16", nodata=INT16_NODATA)
+                tags["scale_factor"] = str(INT16_SCALE)
+
+            # пишем напрямую через rasterio, без разбора DataArray в rioxarray.
+            # Сначала в .part, потом os.replace — недописанный TIF не выглядит готовым.
+            part_path = out_path + PART_SUFFIX
+            try:
+                with rasterio.open(part_path, "w", **profile) as dst:
+                    dst.write(arr, 1)
+                    if tags:
+                        dst.update_tags(**tags)
+                os.replace(part_path, out_path)
+                logger.info(f"      ✅ TIF сохранён: {out_path}")
+            except Exception as e:
+                logger.error(f"      ❌ Ошибка при записи GeoTIFF: {e}")
+                if os.path.exists(part_path):
+                    os.remove(part_path)
 
-            tmp_grib_name = f"tmp_{component}_{date_str}_f{fff}.grib2"
-            tmp_grib_path = os.path.join(OUTPUT_DIR, tmp_grib_name)
 
-            print(f"    -> Скачиваем GRIB2 ({component} 10m)...")
-            resp = requests.get(base_url, params=params, stream=True)
+def convert_grib_bytes_to_tif(data: bytearray, tmp_grib_path: str, out_paths: Dict[str, str]):
+    """
+    Выполняется в процессе пула. cfgrib/eccodes читают GRIB только по пути,
+    поэтому файл на диске живёт лишь на время конвертации.
+    """
+    with open(tmp_grib_path, "wb") as f:
+        f.write(data)
+    try:
+        convert_grib_to_tif_cfgrib(tmp_grib_path, out_paths)
+    finally:
+        # в процессах пула atexit не срабатывает — выводим лог файла сразу
+        flush_log()
+        # старые cfgrib могут проигнорировать indexpath="" и оставить <grib>.<hash>.idx
+        for path in [tmp_grib_path] + glob.glob(glob.escape(tmp_grib_path) + ".*idx"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+async def fetch_grib(client: httpx.AsyncClient, sem: asyncio.Semaphore,
+                     base_url: str, params: dict, tag: str) -> Optional[bytearray]:
+    """
+    Скачивает один GRIB2 в память. На 429/5xx ждёт и повторяет.
+    """
+    async with sem:
+        for attempt in range(MAX_RETRIES):
+            delay = 2 ** attempt
+            try:
+                async with client.stream("GET", base_url, params=params) as resp:
+                    if resp.status_code in RETRY_STATUSES:
+                        retry_after = resp.headers.get("Retry-After", "")
+                        if retry_after.isdigit():
+                            delay = float(retry_after)
+                        logger.warning(f"    ⏳ {tag}: HTTP {resp.status_code}, повтор через {delay:.0f} с")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    if resp.status_code != 200:
+                        await resp.aread()
+                        logger.error(f"    ❌ Ошибка HTTP для {tag} {resp.status_code}: {resp.text[:200]}")
+                        return None
+
+                    # буфер сразу под Content-Length (если тело не сжато) — без
+                    # перевыделений по ходу и без копии BytesIO.getvalue()
+                    length = resp.headers.get("Content-Length", "")
+                    size = 0 if resp.headers.get("Content-Encoding") or not length.isdigit() else int(length)
+                    buf = bytearray(size)
+                    pos = 0
+                    async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK):
+                        buf[pos:pos + len(chunk)] = chunk
+                        pos += len(chunk)
+                    del buf[pos:]
+                    encoding = resp.headers.get("Content-Encoding")
+                    if encoding:
+                        logger.info(f"      ℹ {tag}: {encoding}, {resp.num_bytes_downloaded} -> {pos} байт")
+                    return buf
+            except httpx.TransportError as e:
+                logger.warning(f"    ⏳ {tag}: {e!r}, повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    logger.error(f"    ❌ {tag}: NOMADS не ответил после {MAX_RETRIES} попыток")
+    return None
+
+
+async def run_is_posted(client: httpx.AsyncClient, day: date) -> bool:
+    """
+    Один HEAD на f000: если прогон ещё не выложен, день пропускаем целиком,
+    а не ловим 48 ошибок подряд.
+    """
+    base_url, params = build_gfs_url(day, RUN_HOUR, 0, components=("U",))
+    for attempt in range(MAX_RETRIES):
+        delay = 2 ** attempt
+        try:
+            resp = await client.head(base_url, params=params)
+            if resp.status_code == 200:
+                return True
+            if resp.status_code not in RETRY_STATUSES:
+                logger.warning(f"  ⚠ Прогон {day} {RUN_HOUR:02d}Z недоступен (HTTP {resp.status_code}), пропускаем день")
+                return False
+            logger.warning(f"  ⏳ {day}: HTTP {resp.status_code} на проверке f000, повтор через {delay:.0f} с")
+        except httpx.TransportError as e:
+            logger.warning(f"  ⏳ {day}: {e!r} на проверке f000, повтор через {delay:.0f} с")
+        await asyncio.sleep(delay)
+
+    logger.error(f"  ❌ {day}: NOMADS не ответил на проверку f000, пропускаем день")
+    return False
+
+
+async def fetch_and_convert(client: httpx.AsyncClient, sem: asyncio.Semaphore,
+                            pool: ProcessPoolExecutor, day: date, fh: int,
+                            tif_paths: Dict[str, str]):
+    """
+    tif_paths: только недостающие компоненты часа, {'U': путь, 'V': путь}
+    """
+    date_str = day.strftime("%Y%m%d")
+    fff = f"{fh:03d}"
+    tag = f"{date_str} f{fff}"
 
-            if resp.status_code != 200:
-                print(f"    ❌ Ошибка HTTP для {component} {resp.status_code}: {resp.text[:200]}")
-                continue
+    # U и V одного часа — одним запросом, делим уже после скачивания
+    base_url, params = build_gfs_url(day, RUN_HOUR, fh, components=tuple(tif_paths))
 
-            with open(tmp_grib_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+    tmp_grib_name = f"{TMP_GRIB_PREFIX}{date_str}_f{fff}.grib2"
+    tmp_grib_path = os.path.join(GRIB_TMPDIR, tmp_grib_name)
 
-            print(f"      ✔ GRIB {component} временно сохранён: {tmp_grib_path}")
+    logger.info(f"    -> Скачиваем GRIB2 ({tag} {'+'.join(tif_paths)})...")
+    data = await fetch_grib(client, sem, base_url, params, tag)
+    if data is None:
+        return
+    logger.info(f"      ✔ GRIB {tag} получен: {len(data)} байт")
 
-            try:
-                convert_grib_to_tif_cfgrib(tmp_grib_path, tif_path)
-            finally:
-                if os.path.exists(tmp_grib_path):
-                    os.remove(tmp_grib_path)
+    # cfgrib/GDAL — CPU, в отдельном процессе, пока качаются следующие часы
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(pool, convert_grib_bytes_to_tif, data, tmp_grib_path, tif_paths)
 
 
+async def download_gfs_wind10m_for_day(client: httpx.AsyncClient, pool: ProcessPoolExecutor, day: date):
 
+    logger.info(f"\n=== Обработка даты {day} (run {RUN_HOUR:02d}Z) ===")
 
-def cleanup_output_folder():
+    # один listdir вместо 48 проверок exists: что уже есть — не трогаем
+    date_str = day.strftime("%Y%m%d")
+    existing = set(os.listdir(OUTPUT_DIR))
+    missing: Dict[int, Dict[str, str]] = {}
+    for fh in FORECAST_HOURS:
+        for component in ("U", "V"):
+            tif_name = f"{date_str}_{fh:02d}_{component}_GFS.tif"
+            if tif_name not in existing:
+                missing.setdefault(fh, {})[component] = os.path.join(OUTPUT_DIR, tif_name)
 
-    print("\n=== Финальная очистка OUTPUT_DIR ===")
-    for fname in os.listdir(OUTPUT_DIR):
-        fpath = os.path.join(OUTPUT_DIR, fname)
+    if not missing:
+        logger.info(f"  ✔ Все TIF за {day} уже есть, пропускаем день")
+        return
 
-        # Оставляем только TIFF
-        if fname.lower().endswith(".tif"):
-            continue
+    if not await run_is_posted(client, day):
+        return
 
-        # Удаляем всё остальное
-        if os.path.isfile(fpath):
-            try:
-                os.remove(fpath)
-                print(f"    🗑 Удалено: {fname}")
-            except Exception as e:
-                print(f"    ⚠ Ошибка удаления {fname}: {e}")
+    sem = asyncio.Semaphore(DAY_CONCURRENCY)
+    tasks = [
+        fetch_and_convert(client, sem, pool, day, fh, tif_paths)
+        for fh, tif_paths in missing.items()
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    for r in results:
+        if isinstance(r, Exception):
+            logger.error(f"    ❌ Ошибка для {day}: {r}")
+
+
+
+
+def sweep_stale_files():
+    # Хвосты прошлого упавшего запуска: недописанные .part и временные GRIB/.idx.
+    # Штатно они не остаются, поэтому финальная очистка не нужна.
+    # tmp_*.grib2 в OUTPUT_DIR — от старых версий, писавших GRIB рядом с TIF
+    sweeps = [
+        (OUTPUT_DIR, lambda n: n.endswith(PART_SUFFIX) or (n.startswith("tmp_") and ".grib2" in n)),
+        (GRIB_TMPDIR, lambda n: n.startswith(TMP_GRIB_PREFIX) and ".grib2" in n),
+    ]
+    for folder, is_stale in sweeps:
+        with os.scandir(folder) as it:
+            for entry in it:
+                name = entry.name
+                if not is_stale(name) or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    os.remove(entry.path)
+                    logger.info(f"    🗑 Удалено: {name}")
+                except Exception as e:
+                    logger.warning(f"    ⚠ Ошибка удаления {name}: {e}")
+
+
+def _new_client() -> httpx.AsyncClient:
+    # все запросы дня идут через keep-alive соединения (HTTP/2, если есть h2),
+    # без TCP/TLS на каждый файл
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                          keepalive_expiry=60)
+    return httpx.AsyncClient(http2=HTTP2, limits=limits, timeout=HTTP_TIMEOUT, headers=HTTP_HEADERS)
+
+
+async def _download_day_async(day: date):
+    # пул конвертации живёт ровно один день: долгоживущий пул внутри воркера
+    # внешнего пула зависает на shutdown при выходе процесса
+    with ProcessPoolExecutor(max_workers=CONVERT_WORKERS, initializer=_drop_inherited_log) as pool:
+        async with _new_client() as client:
+            await download_gfs_wind10m_for_day(client, pool, day)
+
+
+def run_day(day: date):
+    # точка входа процесса пула: свой event loop, клиент и пул конвертации
+    try:
+        asyncio.run(_download_day_async(day))
+    except Exception as e:
+        logger.error(f"  ❌ Общая ошибка для {day}: {e}")
+    finally:
+        # граница дня — выводим накопленный лог
+        flush_log()
 
 
 def main():
-    print(f"OUTPUT_DIR: {OUTPUT_DIR}")
-
-    for i in range(NUM_DAYS):
-        day = START_DAY + timedelta(days=i)
-        try:
-            download_gfs_wind10m_for_day(day)
-        except Exception as e:
-            print(f"  ❌ Общая ошибка для {day}: {e}")
+    logger.info(f"OUTPUT_DIR: {OUTPUT_DIR}")
+    sweep_stale_files()
+    flush_log()
 
-    # В конце подчистим всё, кроме TIF
-    cleanup_output_folder()
+    days = [START_DAY + timedelta(days=i) for i in range(NUM_DAYS)]
+    with ProcessPoolExecutor(max_workers=DAY_WORKERS) as ex:
+        list(ex.map(run_day, days))
 
 
 if __name__ == "__main__":